@@ -26,13 +26,56 @@ Note:
 
 import sys
 import os
-import wave
-from datetime import datetime, date
+import errno
+import struct
+import threading
+import time
+import mmap
+import ctypes
+from datetime import datetime
+from types import SimpleNamespace
 
 import sounddevice as sd
 import logging as LOG
 from getopt import getopt
 import numpy as np
+try:
+    from numba import njit  # optional: fuses the float to int16 conversion into one pass
+except ImportError:
+    njit = None
+
+if njit is not None:
+    @njit(cache=True, boundscheck=False, fastmath=True)
+    def f32_to_i16(src, dst, tmp):
+        '''Scale, round and clip float samples into dst in a single pass (tmp unused)'''
+        for i in range(src.size):
+            v = np.rint(src[i] * 32767.0)
+            if v > 32767.0:
+                v = 32767.0
+            elif v < -32768.0:
+                v = -32768.0
+            dst[i] = np.int16(v)
+else:
+    def f32_to_i16(src, dst, tmp):
+        '''Scale, round and clip float samples into dst, using tmp as float32 scratch'''
+        np.multiply(src, 32767.0, out=tmp)
+        np.rint(tmp, out=tmp)
+        np.clip(tmp, -32768, 32767, out=tmp)
+        np.copyto(dst, tmp, casting='unsafe')
+
+def int16_passthrough(buf):
+    '''int16 stream: blocks go to the file as they are'''
+    return buf
+
+def float_to_int16(size):
+    '''Return a block handler for a float32 stream, converting up to size samples per call'''
+    scratch_f32 = np.empty(size, dtype=np.float32)
+    scratch_i16 = np.empty(size, dtype=np.int16)
+    def process_block(buf):
+        i16 = scratch_i16[:buf.size]
+        f32_to_i16(buf, i16, scratch_f32[:buf.size])
+        return i16
+    return process_block
 
 class CFG:
     '''Class to contain config parameters with default values'''
@@ -43,20 +86,87 @@ class CFG:
         self.device_name = ''  # use -q to query device available
         self.device_index = -1 # ditto
         self.blocksize = 1024  # 0.064 secs for fs = 16000 Hz.
+        self.cpu = -1          # CPU to pin the writer thread to (Linux), -1 for no pinning
+        self.ring_blocks = 64  # blocks held in the ring buffer (~4 secs at the defaults),
+                               # rounded up to a power of two
         self.query_device = False # to query about recording device
         self.audio_file_path = 'audio_data' # folder name for audio files
         self.log_file_path = 'logs'         # falder name for log files
         self.end_time = '23:59' # time to end record daily. Use cronjob for the start time
                                 # set it to '-1:0' to record forever
+        self.end_time_hour = 23   # end_time as parsed by parse_cmdline()
+        self.end_time_minute = 59
+
+MAP_FIXED = 0x10  # not exported by the mmap module
+
+def mirrored_buffer(nbytes):
+    '''Map one memfd twice, back to back, so that byte nbytes+i aliases byte i.
+    Linux only; nbytes must be a multiple of the page size.
+    Returns the memfd and a ctypes buffer of 2*nbytes.'''
+    libc = ctypes.CDLL(None, use_errno=True)
+    libc.mmap.restype = ctypes.c_void_p
+    libc.mmap.argtypes = (ctypes.c_void_p, ctypes.c_size_t, ctypes.c_int,
+                          ctypes.c_int, ctypes.c_int, ctypes.c_long)
+    prot = mmap.PROT_READ | mmap.PROT_WRITE
+
+    fd = os.memfd_create('audio_ring')
+    try:
+        os.ftruncate(fd, nbytes)
+        # reserve the whole range first, then replace both halves with the memfd
+        base = libc.mmap(None, 2*nbytes, prot, mmap.MAP_PRIVATE | mmap.MAP_ANONYMOUS, -1, 0)
+        if base in (None, ctypes.c_void_p(-1).value):
+            raise OSError(ctypes.get_errno(), 'mmap failed to reserve the ring')
+        for addr in (base, base + nbytes):
+            if libc.mmap(addr, nbytes, prot, mmap.MAP_SHARED | MAP_FIXED, fd, 0) != addr:
+                raise OSError(ctypes.get_errno(), 'mmap failed to map the ring')
+    except OSError:
+        os.close(fd)
+        raise
+    return fd, (ctypes.c_char * (2*nbytes)).from_address(base)
+
+class AudioRing:
+    '''Fixed-size single-producer/single-consumer ring of audio blocks.
+
+    The PortAudio callback is the only writer of head, stream_record() the only
+    writer of tail, so no lock is needed. The callback sets event after each block.
+    head and tail only ever grow; the slot of block i is i & mask.
+
+    On Linux the ring is double-mapped: blocks has 2*n_blocks rows and row
+    n_blocks+i is the same memory as row i, so any run of up to n_blocks
+    blocks can be read as one contiguous array, even across the wrap.
+    '''
+    def __init__(self, n_blocks, blocksize, dtype):
+        # a power of two, so that a slot is head/tail & mask rather than a modulo
+        n_blocks = 1 << (n_blocks - 1).bit_length()
+        self.n_blocks = n_blocks
+        self.mask = n_blocks - 1
+        self.fd = None  # memfd backing the ring when double-mapped
+        self.nbytes = nbytes = n_blocks * blocksize * np.dtype(dtype).itemsize
+        if hasattr(os, 'memfd_create') and nbytes % mmap.PAGESIZE == 0:
+            try:
+                self.fd, mem = mirrored_buffer(nbytes)
+                self.blocks = np.frombuffer(mem, dtype=dtype).reshape(2*n_blocks, blocksize)
+            except OSError as e:
+                LOG.warning(f'Cannot double-map the audio ring, using a plain one: {e}')
+        if self.fd is None:
+            self.blocks = np.empty((n_blocks, blocksize), dtype=dtype)
+        # (blocksize, 1) views of each slot, built once so that the callback can
+        # copy indata straight in without creating any array objects
+        self.slots = [block.reshape(-1, 1) for block in self.blocks[:n_blocks]]
+        self.head = 0  # total blocks written by the callback
+        self.tail = 0  # total blocks consumed by the writer
+        self.overruns = 0  # blocks dropped by the callback because the ring was full
+        self.event = threading.Event()
 
 def usage():
     print(f'{sys.argv[0]} [-h] [-q] [-a <audio_file_path>] [-l <log_file_path>]',
-        '[-r <rate>] [-d <device>] [-b <blocksize>] [-D <dura>] [-e end_time')
+        '[-r <rate>] [-d <device>] [-b <blocksize>] [-D <dura>] [-e end_time] [-c <cpu>]')
     print('   where <rate> is the sampling frequency in Hz')
     print('   -h to print this help page')
     print('   -q is to query recording device (hardware) to help you select a device')
     print('   for <dura> (duration in secs), the short version is uppercased -D')
     print('   and <device> can be an integer (device_index) or a string (device_name).')
+    print('   -c pins the file writer thread to CPU <cpu> (Linux only)')
     sys.exit(0)
 
 def parse_cmdline(argv):
@@ -64,8 +174,9 @@ def parse_cmdline(argv):
     cfg = CFG()
 
     try:
-        opts, args = getopt(argv, "hqa:l:r:d:b:e:D:", 
-            ['audio_file_path=', 'log_file_path=', 'rate=', 'device=', 'blocksize=', 'end_time=', 'dura='])
+        opts, args = getopt(argv, "hqa:l:r:d:b:e:D:c:", 
+            ['audio_file_path=', 'log_file_path=', 'rate=', 'device=', 'blocksize=', 'end_time=', 'dura=',
+             'cpu='])
     except getopt.GetoptError as e:
         print('getopt error in parse_cmdline(): ', e)
         usage()
@@ -95,10 +206,23 @@ def parse_cmdline(argv):
                 cfg.audio_file_path = arg
             elif opt in ("-l", "--log_file_path"):
                 cfg.log_file_path = arg
+            elif opt in ("-c", "--cpu"):
+                cfg.cpu = int(arg)
     except ValueError as e:
         print(f'ValueError: {e}. Please check the command line.')
         usage()
 
+    try:
+        end_time = cfg.end_time.strip().split(':')
+        cfg.end_time_hour, cfg.end_time_minute = int(end_time[0]), int(end_time[1])
+        # a negative hour means no end time; otherwise it must be a valid time of day
+        if cfg.end_time_hour >= 0 and not (cfg.end_time_hour <= 23 and 0 <= cfg.end_time_minute <= 59):
+            raise ValueError(cfg.end_time)
+    except (ValueError, IndexError):
+        print(f'Bad end_time ({cfg.end_time}), expecting <hour>:<min> with hour in [0, 23]',
+              'or a negative hour to record forever. Please check the command line.')
+        usage()
+
     return cfg
 
 def mkdir_folder(folder_name):
@@ -121,51 +245,206 @@ def callback(indata, frames, timeinfo, status):
     if status:
         print(status)
         LOG.error(f'status={status}')
-    global audio_buffer
-    audio_buffer = indata.copy()
-
-def stream_record(daily_path='', session=0, frames=4_800_000, cfg=None):
+    if ring.head - ring.tail >= ring.n_blocks:
+        # the writer is a whole ring behind: drop this block rather than
+        # overwrite blocks it has not written out yet
+        ring.overruns += 1
+        return
+    np.copyto(ring.slots[ring.head & ring.mask], indata)
+    ring.head += 1
+    ring.event.set()
+
+# RIFF/WAVE header for 16-bit linear PCM: 44 bytes, the two sizes are at offsets 4 and 40
+WAV_HEADER = struct.Struct('<4sI4s4sIHHIIHH4sI')
+
+def wav_header(cfg, nframes):
+    nbytes = nframes * cfg.channels * 2
+    return WAV_HEADER.pack(b'RIFF', 36 + nbytes, b'WAVE', b'fmt ', 16, 1, cfg.channels,
+                           cfg.fs, cfg.fs * cfg.channels * 2, cfg.channels * 2, 16, b'data', nbytes)
+
+def open_session(daily_path, session, header):
     fname_trunk = '{:%Y%m%dh%Hm%M}'.format(datetime.now())  # Note the colon token
     fname = f'{daily_path}{os.path.sep}{fname_trunk}S{session:02d}.wav'
     LOG.info(f'recording session: {session} {fname=}')
-    wf = wave.open(fname, 'wb')
-    wf.setnchannels(cfg.channels)
-    wf.setsampwidth(2)
-    wf.setframerate(cfg.fs)
-
-    global audio_buffer
-    n_frames = 0
-    print_instants = [int(x) for x in np.linspace(0, frames, 10)]
-    next_mark = 0.
-    delta_mark = 20.
-    while n_frames < frames:
-        while True:
-            if audio_buffer.shape[0] == cfg.blocksize:
-                break
-
-        buf = audio_buffer[:, 0]
-        # reset audio_buffer. Don't add too much process here to avoid racing conditions
-        audio_buffer = np.array([]).reshape(0, 1)
-
-        if buf.dtype != np.int16:
-            '''Convert it to 16-bit integers (aka shorts)'''
-            buf *= 32768
-            buf = buf.astype(np.int16)
-
-        completed = n_frames*100./frames
-        if completed >= next_mark:
-            next_mark += delta_mark
-            print(f'\r>> Completing {(n_frames*100./frames):.1f}%...', end='')
+    fd = os.open(fname, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+    os.write(fd, header)
+    return fd
+
+def write_all(fd, data):
+    '''os.write() until all of data is written (it may write less than asked)'''
+    data = memoryview(data).cast('B')
+    while data:
+        data = data[os.write(fd, data):]
+
+def send_ring(fd, offset, nbytes):
+    '''Copy nbytes of the ring, starting at byte offset, to fd with sendfile(2).
+    The data goes from the ring's memfd to the file inside the kernel, without
+    a pass through a user-space buffer. Unlike the mapping, the memfd itself
+    does not wrap, so a run across its end takes two calls.
+    Returns the number of bytes sent, which is short of nbytes if sendfile()
+    turns out not to work here (EINVAL/ENOSYS); the caller writes the rest.'''
+    sent = 0
+    while sent < nbytes:
+        offset %= ring.nbytes
+        try:
+            n = os.sendfile(fd, ring.fd, offset, min(nbytes - sent, ring.nbytes - offset))
+        except OSError as e:
+            if e.errno not in (errno.EINVAL, errno.ENOSYS):
+                raise
+            LOG.warning(f'sendfile() cannot read the ring, using write() instead: {e}')
+            break
+        offset += n
+        sent += n
+    return sent
+
+def close_session(fd, n_frames, cfg):
+    '''Close a session cut short, patching the header sizes to the n_frames written'''
+    nbytes = n_frames * cfg.channels * 2
+    os.pwrite(fd, struct.pack('<I', 36 + nbytes), 4)
+    os.pwrite(fd, struct.pack('<I', nbytes), 40)
+    os.close(fd)
+
+def report_overruns(session, overruns):
+    '''Log the blocks dropped since the last report; returns the new running total'''
+    if ring.overruns != overruns:
+        LOG.error(f'{ring.overruns - overruns} blocks dropped in session {session}: ring buffer full')
+    return ring.overruns
+
+def set_writer_priority(cfg):
+    '''Pin the calling thread to cfg.cpu and move it to SCHED_FIFO, where the OS
+    allows it (Linux). Failures are only logged: the ring still absorbs stalls.'''
+    if cfg.cpu >= 0 and hasattr(os, 'sched_setaffinity'):
+        try:
+            os.sched_setaffinity(0, {cfg.cpu})  # 0 is the calling thread on Linux
+        except OSError as e:
+            LOG.warning(f'Cannot pin the writer thread to CPU {cfg.cpu}: {e}')
+    if hasattr(os, 'sched_setscheduler'):
+        try:
+            os.sched_setscheduler(0, os.SCHED_FIFO, os.sched_param(10))
+        except PermissionError as e:
+            LOG.warning(f'Cannot give the writer thread realtime priority (SCHED_FIFO): {e}')
 
-        n_frames += buf.shape[0]
-        wf.writeframes(b''.join(buf))
-    
-    print('\r>> Completed 100.% session='+str(session))
-    wf.close() # done with a particular session
+def stream_record(status=None, **kwargs):
+    '''Writer thread target: run drain_ring() and keep any exception in status.error,
+    so that main() can report the failure instead of a normal end of recording.'''
+    try:
+        drain_ring(**kwargs)
+    except Exception as e:
+        LOG.exception(f'The writer thread failed: {e}')
+        status.error = e
+
+def drain_ring(frames=4_800_000, cfg=None, stop=None, process_block=int16_passthrough):
+    '''Drain the ring into consecutive session files of exactly `frames` frames.
+
+    Runs in its own thread for the whole recording. Files are rolled over inline,
+    between two writes, so the ring keeps being drained across session boundaries.
+    Returns when the daily end time is reached, or when stop is set and the
+    blocks already captured have been written out.
+    process_block turns a batch of ring blocks into int16 samples; it is picked
+    once for the stream dtype, so no per-batch type check is needed.
+    '''
+    set_writer_priority(cfg)
+    end_time_hour, end_time_minute = cfg.end_time_hour, cfg.end_time_minute
+    current_day = -1
+    session = 0
+    fd = None
+    overruns = 0
+    print_step = frames // 5  # progress is reported every 20% of a session
+    # \r progress lines only make sense on a terminal; under cron/systemd they go to the log
+    tty = sys.stdout.isatty()
+    # The frame count is known up front, so the header bytes are built once and are
+    # right the first time; only a session cut short needs its header patched.
+    header = wav_header(cfg, frames)
+
+    # int16 blocks in a memfd-backed ring can be sent to the file by the kernel
+    zero_copy = ring.fd is not None and process_block is int16_passthrough
+
+    # Everything the drain loop touches is bound to a local once, so the Python
+    # work per batch is a handful of local lookups; the write/sendfile calls
+    # themselves run without the GIL.
+    blocks, mask, n_ring = ring.blocks, ring.mask, ring.n_blocks
+    double_mapped = ring.fd is not None
+    block_bytes = cfg.blocksize * blocks.itemsize
+    wait, clear, stopped = ring.event.wait, ring.event.clear, stop.is_set
+    tail = ring.tail
 
-    return
+    try:
+        while True:
+            while tail == ring.head and not stopped():
+                # sleep until the callback delivers the next block (no busy-wait)
+                wait()
+                clear()
+            if tail == ring.head:
+                break  # stopped, and nothing captured is left in the ring
+
+            # Drain every block that is ready (up to the end of the ring unless it
+            # is double-mapped) with as few writes as possible, so that the
+            # per-write cost is paid once per batch rather than once per block.
+            start = tail & mask
+            span = n_ring if double_mapped else n_ring - start
+            n_blocks = min(ring.head - tail, span)
+            buf = process_block(blocks[start:start + n_blocks].reshape(-1))
+            offset = start * block_bytes  # byte offset in the memfd
+
+            while buf.size:
+                if fd is None:
+                    tid = datetime.now()
+                    if tid.toordinal() != current_day:
+                        # new day: folder and end time are worked out once per day
+                        current_day = tid.toordinal()
+                        daily_path = f'{cfg.audio_file_path}{os.path.sep}{tid:%Y%m%d}'
+                        mkdir_folder(daily_path)
+                        if end_time_hour < 0:
+                            end_dt = datetime.max  # run this script forever (beyond this day)
+                        else:
+                            end_dt = tid.replace(hour=end_time_hour, minute=end_time_minute,
+                                                 second=0, microsecond=0)
+                    if tid >= end_dt:
+                        return
+
+                    fd = open_session(daily_path, session, header)
+                    n_frames = 0
+                    next_print_frames = 0 if tty else print_step
+
+                if n_frames >= next_print_frames:
+                    next_print_frames += print_step
+                    if tty:
+                        print(f'\r>> Completing {(n_frames*100./frames):.1f}%...', end='')
+                    else:
+                        LOG.info(f'session {session} {n_frames*100//frames}%')
+
+                # a batch may straddle two sessions: the rest goes to the next file
+                n = min(buf.size, frames - n_frames)
+                # the samples go to the file as they are: one write per batch
+                nbytes = n * buf.itemsize
+                sent = 0
+                if zero_copy:
+                    sent = send_ring(fd, offset, nbytes)
+                    zero_copy = sent == nbytes
+                if sent < nbytes:
+                    write_all(fd, memoryview(buf[:n]).cast('B')[sent:])
+                offset += nbytes
+                buf = buf[n:]
+                n_frames += n
+
+                if n_frames == frames:
+                    if tty:
+                        print('\r>> Completed 100.% session='+str(session))
+                    os.close(fd) # done with a particular session
+                    fd = None
+                    overruns = report_overruns(session, overruns)
+                    LOG.StreamHandler().flush()
+                    session += 1
+
+            tail += n_blocks
+            ring.tail = tail  # the slots may be reused by the callback from now on
+    finally:
+        if fd is not None:
+            close_session(fd, n_frames, cfg)
+        report_overruns(session, overruns)  # drops in a session cut short
 
 def main(argv):
+    global ring
     if cfg.query_device:
         device = sd.query_devices(kind='input')
         print('Available device for INPUT (recording):\n', device)
@@ -184,7 +463,10 @@ def main(argv):
     print(f'device={device}')
 
     stream = None
-    for dtype in ['float32', 'float24', 'int16']:
+    # int16 first: blocks then go from the ring to the file as they are, with no
+    # conversion, and only half the bytes of float32 are moved around
+    # (sounddevice has no float24 for numpy arrays, so there is nothing else to try)
+    for dtype in ['int16', 'float32']:
         try:
             stream = sd.InputStream(
                 samplerate=cfg.fs,
@@ -195,14 +477,14 @@ def main(argv):
                 clip_off=False,
                 callback=callback,
                 )
-            break  # either float32/24 or int16 works (in this order)
+            break  # either int16 or float32 works (in this order)
         except Exception as e:
-            if dtype == 'float32' or dtype == 'float24':
+            if dtype == 'int16':
                 print(f'The recording device does not support {dtype}. Trying another now', file=sys.stderr)
                 LOG.warning(f'The recording device does not support {dtype}.')
             else:
-                print('The recording device does not support int16 either', file=sys.stderr)
-                LOG.warning('The recording device does not support int16 either')
+                print('The recording device does not support float32 either', file=sys.stderr)
+                LOG.warning('The recording device does not support float32 either')
             LOG.warning(f'Exception={e}')
             continue
     else:
@@ -212,35 +494,42 @@ def main(argv):
         sys.exit(1)
 
     print('Recording stream created successfully', device, dtype)
+    ring = AudioRing(cfg.ring_blocks, cfg.blocksize, stream.dtype)
+    # the stream dtype is fixed from now on: choose the per-block handler once
+    if dtype == 'int16':
+        process_block = int16_passthrough
+    else:
+        process_block = float_to_int16(ring.n_blocks * cfg.blocksize)
     LOG.StreamHandler().flush()
 
     # Ready to take off!
+    frames = int(cfg.dura * cfg.fs)
+    stop = threading.Event()
+    status = SimpleNamespace(error=None)  # set by the writer thread if it fails
+    writer = threading.Thread(target=stream_record, name='writer',
+                              kwargs=dict(status=status, frames=frames, cfg=cfg, stop=stop,
+                                          process_block=process_block))
     try:
         stream.start()
-        session = 0
-        frames = int(cfg.dura * cfg.fs)
-        end_time = cfg.end_time.strip().split(':')
-        end_time_hour, end_time_minute = int(end_time[0]), int(end_time[1])
-        current_day = -1
-
-        while True:
-            tid = datetime.now()
-            if '{:%Y%m%d}'.format(tid) != current_day:
-                current_day = '{:%Y%m%d}'.format(date.today())
-                daily_path = f'{cfg.audio_file_path}{os.path.sep}{current_day}'
-                mkdir_folder(daily_path)
-            if (tid.hour != -1 and tid.hour > end_time_hour) or \
-                (tid.hour == end_time_hour and tid.minute >= end_time_minute):
-                # tid.hour = -1 will run this script forever (beyond this day)
-                break
-
-            stream_record(daily_path=daily_path, session=session, frames=frames, cfg=cfg)
-            LOG.StreamHandler().flush()
-            session += 1
+        writer.start()
+        while writer.is_alive():
+            # poll rather than join(): a join() interrupted by Ctrl-C marks the
+            # thread as finished, and then the final join() would not wait for it
+            time.sleep(0.5)
 
     except KeyboardInterrupt:
         LOG.warning('Received a KeyboardInterrupt')
         print('\nReceived a KeyboardInterrupt', file=sys.stderr)
+        # stop capturing, then let the writer write out what is left in the
+        # ring and close the current file properly
+        try:
+            stream.stop()
+        except:
+            pass
+        stop.set()
+        ring.event.set()
+        if writer.ident is not None:  # Ctrl-C may come before the writer started
+            writer.join()
 
     else:
         try:
@@ -248,6 +537,11 @@ def main(argv):
             stream.close()
         except:
             pass
+        if status.error is not None:
+            LOG.error(f'Recording stopped by a writer failure: {status.error!r}')
+            print(f'\nRecording stopped by a writer failure: {status.error!r}', file=sys.stderr)
+            LOG.shutdown()
+            sys.exit(1)
         LOG.warning('Recording time is up')
         print('\nRecording time is up\nDONE', file=sys.stderr)
 
@@ -269,8 +563,5 @@ if __name__ == "__main__":
     LOG.info(f'Working directory is {os.getcwd()}')
     mkdir_folder(cfg.audio_file_path)
 
-    # initialization
-    audio_buffer = np.array([]).reshape(0, 1)
-
     main(sys.argv[:])
 